@@ -5,6 +5,7 @@
 
 import sys, os, re, pickle, numpy as np, pandas as pd
 from collections import defaultdict
+from utils import progress
 
 
 def getParams(paramFile):
@@ -316,9 +317,8 @@ def iso_distri(iso_mass_inten_dict, chemical_com, Charge, isotope_cutoff, mass_t
     return pep_iso_distr_df
 
 
-def getIsotopicDistributions(paramFile, inputFile):
-    params = getParams(paramFile)
-    inputDf = pd.read_csv(inputFile)
+def getElementDistributions(params):
+    # Isotopic distributions of elements (including user-defined tracer elements) used for all compounds
     preComputedIsotopes = os.path.join(os.path.dirname(os.path.abspath(__file__)), "isotopeMassIntensity.pkl")
 
     # Open the default elementary dictionary
@@ -362,54 +362,189 @@ def getIsotopicDistributions(paramFile, inputFile):
 
     iso_mass_inten_dict = isotope_distribution_indElement(elemInfo_dict, iso_mass_inten_dict,
                                                           inten_threshold_trim=1e-10)
-    iso_distr_all = pd.DataFrame(columns=['isotopologues', 'isotope_m/z', 'isotope_intensity'])
-    # inputData = pd.DataFrame()
+    return iso_mass_inten_dict
+
+
+# Mass differences between the heavy and light isotopes of tracer elements
+tracerMassShift = {"13C": 13.00335483521 - 12, "15N": 15.0001088989 - 14.00307400446}
+
+
+def getTracers(params):
+    # Tracer(s) given by "Tracer_1" and "Tracer_2" parameters, e.g., ["13C"] or ["13C", "15N"]
+    tracers = []
+    for key in ["Tracer_1", "Tracer_2"]:
+        if key in params and params[key] in tracerMassShift and params[key] not in tracers:
+            tracers.append(params[key])
+    return tracers
+
+
+def parseIsotopologue(label):
+    # Numbers of 13C and 15N labels of an isotopologue of the dual-tracer (13C + 15N) experiment
+    # e.g., "M0" -> (0, 0), "M2,1" -> (2, 1) (i.e., two 13C and one 15N)
+    if "," in label:
+        nC, nN = label[1:].split(",")
+        return int(nC), int(nN)
+    else:
+        return int(label[1:]), 0
+
+
+def elementDistribution(iso_mass_inten_dict, element, count):
+    # Isotopic distribution (masses and intensities) of "count" atoms of an element
+    if count == 0:
+        return np.array([0.0]), np.array([1.0])
+    elif count in iso_mass_inten_dict[element]['Mass']:
+        return np.array(iso_mass_inten_dict[element]['Mass'][count], dtype=float).ravel(), \
+               np.array(iso_mass_inten_dict[element]['Intensity'][count], dtype=float).ravel()
+    else:
+        df = iso_distri_largeNum(element, count, iso_mass_inten_dict)
+        return np.array(df.isotope_mass.values, dtype=float), np.array(df.isotope_inten.values, dtype=float)
+
+
+def convolveDistributions(dist1, dist2, threshold=1e-10):
+    # Isotopic distribution of the combination of two distributions (masses are added, intensities are multiplied)
+    # Peaks with the same mass (within 1e-6 Da) are merged, so that the number of peaks does not explode
+    mass = (dist1[0].reshape(-1, 1) + dist2[0].reshape(1, -1)).ravel()
+    inten = (dist1[1].reshape(-1, 1) * dist2[1].reshape(1, -1)).ravel()
+    ind = inten > threshold
+    mass, inten = mass[ind], inten[ind]
+    _, inverse = np.unique(np.round(mass, 6), return_inverse=True)
+    mergedInten = np.bincount(inverse, weights=inten)
+    mergedMass = np.bincount(inverse, weights=mass * inten) / mergedInten
+    return mergedMass, mergedInten
+
+
+def getDualTracerDistributions(iso_mass_inten_dict, chemical_com, charge, params):
+    # Theoretical isotopic distributions of (nC + 1) x (nN + 1) isotopologues of the dual-tracer (13C + 15N) experiment
+    # Isotopologues are ordered as M0 (= "M0,0"), "M0,1", ..., "M0,nN", "M1,0", ..., "MnC,nN" ("Ma,b" = a 13C and b 15N)
+    # Each isotopologue is expanded to its fine isotopic structure, and each peak is assigned to the measured
+    # isotopologue whose exact m/z is within "mass_tolerance" (ppm), i.e., 13C and 15N shifts are resolved
+    # by high resolution. Peaks not resolved to any isotopologue (e.g., 2H, 18O, ...) are not counted
+    # Since the tracer elements are separated from the others, the distribution of the other elements is computed
+    # once, and the distributions of 13C/12C and 15N/14N parts are computed once per number of labels
+    proton = 1.007276466812
+    nC, nN = chemical_com.get("C", 0), chemical_com.get("N", 0)
+    dC, dN = tracerMassShift["13C"], tracerMassShift["15N"]
+    tol = float(params['mass_tolerance'])
+    cutoff = float(params['isotope_cutoff'])
+    monoMass = sum([count * min(iso_mass_inten_dict[element]['Mass'][1]) for element, count in chemical_com.items()])
+
+    # Distributions of elements other than C and N, and the distributions of the N part (14N + 15N)
+    baseDistr = (np.array([0.0]), np.array([1.0]))
+    for element, count in chemical_com.items():
+        if element not in ("C", "N"):
+            baseDistr = convolveDistributions(baseDistr, elementDistribution(iso_mass_inten_dict, element, count))
+    nDistr = [convolveDistributions(elementDistribution(iso_mass_inten_dict, "N", nN - b),
+                                    elementDistribution(iso_mass_inten_dict, "y", b)) for b in range(nN + 1)]
+
+    # Theoretical m/z of measured isotopologues
+    labels = [(a, b) for a in range(nC + 1) for b in range(nN + 1)]
+    n = len(labels)
+    gridMz = np.array([(monoMass + a * dC + b * dN + proton * charge) / abs(charge) for a, b in labels])
+
+    rows = []
+    for a in range(nC + 1):
+        cDistr = convolveDistributions(elementDistribution(iso_mass_inten_dict, "C", nC - a),
+                                       elementDistribution(iso_mass_inten_dict, "x", a))
+        baseCDistr = convolveDistributions(baseDistr, cDistr)
+        for b in range(nN + 1):
+            mass, inten = convolveDistributions(baseCDistr, nDistr[b])
+            inten = inten / inten.sum() * 100
+            mz = (mass + proton * charge) / abs(charge)
+
+            # Assignment of peaks to measured isotopologues
+            # For the nominal mass shift s, the mass shift of (a', s - a') isotopologue is s * dN + a' * (dC - dN)
+            delta = mass - monoMass
+            s = np.round(delta).astype(int)
+            aa = np.round((delta - s * dN) / (dC - dN)).astype(int)
+            bb = s - aa
+            valid = (aa >= 0) & (aa <= nC) & (bb >= 0) & (bb <= nN)
+            k = np.where(valid, aa * (nN + 1) + bb, 0)
+            valid &= np.abs(mz - gridMz[k]) <= gridMz[k] * tol / 1e6
+            intensity = np.bincount(k[valid], weights=inten[valid], minlength=n)
+            weightedMz = np.bincount(k[valid], weights=mz[valid] * inten[valid], minlength=n)
+            observedMz = np.zeros(n)
+            observedMz[intensity > 0] = weightedMz[intensity > 0] / intensity[intensity > 0]
+            intensity[intensity < intensity.max() * cutoff] = 0
+            observedMz[intensity == 0] = 0
+            if a == 0 and b == 0:
+                label = "M0"
+            else:
+                label = "M{},{}".format(a, b)
+            rows.append({'isotopologues': label, 'isotope_m/z': ';'.join([str(f) for f in observedMz]),
+                         'isotope_intensity': ';'.join([str(f) for f in intensity])})
+    return rows
+
+
+def getCompoundDistributions(iso_mass_inten_dict, formula, ion, z, params):
+    # Theoretical isotopic distributions of the isotopologues (M0, M1, ..., Mn) of a compound
+    # Returns a list of dictionaries, {'isotopologues', 'isotope_m/z', 'isotope_intensity'}, one per isotopologue
+    rows = []
+    chemical_com = {k: int(v) if v else 1 for k, v in re.findall(r"([A-Z][a-z]?)(\d+)?", formula)}
+    if ion[-1] == "-":
+        charge = z * (-1)
+    elif ion[-1] == "+":
+        charge = z
+    if len(getTracers(params)) == 2:
+        return getDualTracerDistributions(iso_mass_inten_dict, chemical_com, charge, params)
+
+    # Number of atoms of the tracer element, i.e., isotopologues are M0, M1, ..., M(nLabels)
+    if params["Tracer_1"] == '15N':
+        nLabels = chemical_com.get("N", 0)
+    else:
+        nLabels = chemical_com["C"]
+    chemical_com_ = chemical_com.copy()
+    for j in range(0, nLabels + 1):
+        chemical_com_ = chemical_com.copy()
+        if params["Tracer_1"] == '13C':
+            chemical_com_["C"] = chemical_com_["C"] - j
+            chemical_com_["x"] = j  # x = C13
+            chemical_com_ = {k: v for k, v in chemical_com_.items() if v != 0}
+        elif params["Tracer_1"] == '15N':
+            chemical_com_["N"] = chemical_com_.get("N", 0) - j
+            chemical_com_["y"] = j  # x = N15
+            chemical_com_ = {k: v for k, v in chemical_com_.items() if v != 0}
+
+        iso_distr = iso_distri(iso_mass_inten_dict, chemical_com_, charge,
+                               float(params['isotope_cutoff']), float(params['mass_tolerance']),
+                               float(params['method_merging_isotopic_peaks']), is_pep=0)
+        if 'groups' in iso_distr.columns:
+            iso_distr.drop(['groups'], axis=1, inplace=True)
+
+        iso_distr_temp = pd.DataFrame(0.0, index=np.arange(0, nLabels + 1),
+                                      columns=['isotope_mass', 'isotope_inten'])
+        if len(iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]]) > (nLabels + 1 - j):
+            iso_distr_temp.loc[j:j - 1 + len(iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]]),
+            :] = iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]].values[
+                 :(nLabels + 1 - j)]
+        else:
+            iso_distr_temp.loc[j:j - 1 + len(iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]]),
+            :] = iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]].values
+
+        iso_distr_temp.loc[j - len(iso_distr[iso_distr.isotope_mass < iso_distr.isotope_mass.iloc[0]]):j - 1, :] = \
+        iso_distr[iso_distr.isotope_mass < iso_distr.isotope_mass.iloc[0]].values
+        rows.append({'isotopologues': 'M' + str(j), 'isotope_m/z': ';'.join(
+            [str(f) for f in iso_distr_temp.isotope_mass.values]), 'isotope_intensity': ';'.join(
+            [str(f) for f in iso_distr_temp.isotope_inten.values])})
+    return rows
+
+
+def getIsotopicDistributions(paramFile, inputFile):
+    params = getParams(paramFile)
+    inputDf = pd.read_csv(inputFile)
+    iso_mass_inten_dict = getElementDistributions(params)
+    rows = []
     nameArray = []
+    name = os.path.basename(inputFile)
+    progress.start("distribution", name, len(inputDf), "compounds")
     for i in range(0, len(inputDf)):
-        chemical_com = {k: int(v) if v else 1 for k, v in re.findall(r"([A-Z][a-z]?)(\d+)?", inputDf.formula[i])}
-        chemical_com_ = chemical_com.copy()
-        for j in range(0, chemical_com["C"] + 1):
-            chemical_com_ = chemical_com.copy()
-            if params["Tracer_1"] == '13C':
-                chemical_com_["C"] = chemical_com_["C"] - j
-                chemical_com_["x"] = j  # x = C13
-                chemical_com_ = {k: v for k, v in chemical_com_.items() if v != 0}
-            elif params["Tracer_1"] == '15N':
-                chemical_com_["N"] = chemical_com_["N"] - j
-                chemical_com_["y"] = j  # x = N15
-                chemical_com_ = {k: v for k, v in chemical_com_.items() if v != 0}
-
-            if inputDf.feature_ion[i][-1] == "-":
-                charge = inputDf.feature_z[i] * (-1)
-            elif inputDf.feature_ion[i][-1] == "+":
-                charge = inputDf.feature_z[i]
-            iso_distr = iso_distri(iso_mass_inten_dict, chemical_com_, charge,
-                                   float(params['isotope_cutoff']), float(params['mass_tolerance']),
-                                   float(params['method_merging_isotopic_peaks']), is_pep=0)
-            if 'groups' in iso_distr.columns:
-                iso_distr.drop(['groups'], axis=1, inplace=True)
-
-            iso_distr_temp = pd.DataFrame(0, index=np.arange(0, chemical_com["C"] + 1),
-                                          columns=['isotope_mass', 'isotope_inten'])
-            if len(iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]]) > (chemical_com["C"] + 1 - j):
-                iso_distr_temp.loc[j:j - 1 + len(iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]]),
-                :] = iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]].values[
-                     :(chemical_com["C"] + 1 - j)]
-            else:
-                iso_distr_temp.loc[j:j - 1 + len(iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]]),
-                :] = iso_distr[iso_distr.isotope_mass >= iso_distr.isotope_mass.iloc[0]].values
-
-            iso_distr_temp.loc[j - len(iso_distr[iso_distr.isotope_mass < iso_distr.isotope_mass.iloc[0]]):j - 1, :] = \
-            iso_distr[iso_distr.isotope_mass < iso_distr.isotope_mass.iloc[0]].values
-            iso_distr_all = iso_distr_all.append({'isotopologues': 'M' + str(j), 'isotope_m/z': ';'.join(
-                [str(f) for f in iso_distr_temp.isotope_mass.values]), 'isotope_intensity': ';'.join(
-                [str(f) for f in iso_distr_temp.isotope_inten.values])}, ignore_index=True)
-            nameArray.append(inputDf.iloc[i]["name"])
-            # inputData = inputData.append(inputDf.loc[[i]], ignore_index=True
-            # inputData = inputData.append(inputDf.loc[i]["name"], ignore_index=True)
+        compoundRows = getCompoundDistributions(iso_mass_inten_dict, inputDf.formula[i], inputDf.feature_ion[i],
+                                                inputDf.feature_z[i], params)
+        rows.extend(compoundRows)
+        nameArray.extend([inputDf.iloc[i]["name"]] * len(compoundRows))
+        progress.update("distribution", name)
+    progress.finish("distribution", name)
 
     # Organize the output
-    # iso_distr_all = pd.concat([inputData, iso_distr_all], axis=1)
+    iso_distr_all = pd.DataFrame(rows, columns=['isotopologues', 'isotope_m/z', 'isotope_intensity'])
     iso_distr_all["name"] = nameArray
     return iso_distr_all
-
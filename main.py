@@ -1,8 +1,12 @@
 import os, numpy as np, pandas as pd
-from pyteomics import mzxml
 from datetime import datetime
 from utils import *
 from isotopeCalculation import *
+from resultStorage import *
+from spectrumSource import *
+from service import runService
+from scipy import sparse
+from scipy.sparse.linalg import splu, lsqr
 
 
 def findPeak(spec, givenMz, tol):
@@ -29,15 +33,27 @@ def findIsotopologue(mzxmlFile, infoDf, isRef, params):
         dictM0[uids[i]] = {"mz": mzs[i], "rt": rts[i]}
 
     # Initialization
-    delC = 1.003355
-    tol = 5
-    reader = mzxml.MzXML(mzxmlFile)
-    ms1Scans = []
-    ms1RTs = []
-    for spec in reader:
-        if spec["msLevel"] == 1:
-            ms1Scans.append(spec["num"])
-            ms1RTs.append(spec["retentionTime"])
+    tracers = getTracers(params)
+    if len(tracers) > 0:
+        delM = tracerMassShift[tracers[0]]  # Mass difference of the tracer (e.g., 13C and 12C)
+    else:
+        delM = tracerMassShift["13C"]
+    try:
+        tol = float(params["ms1_tolerance"])
+    except KeyError:
+        tol = 5
+    if isinstance(mzxmlFile, ms1Spectra):   # MS1 spectra are already loaded
+        reader = mzxmlFile
+    else:   # mzXML, mzML or their gzip-compressed file
+        try:
+            nWorkers = int(params["decoding_workers"])
+        except KeyError:
+            nWorkers = 1
+        reader = ms1Spectra(mzxmlFile, nWorkers)
+    ms1Scans = reader.scans
+    ms1RTs = reader.rts
+    name = reader.name
+    progress.start("match", name, len(dictM0), "targets")
 
     # "res" dictionary will have the following format
     # res["id"] = [uid[0], uid[1], ..., uid[n]]
@@ -95,9 +111,22 @@ def findIsotopologue(mzxmlFile, infoDf, isRef, params):
         #####################################
         # Identification of M1, M2, ..., Mn #
         #####################################
-        nIsotopologues = sum(infoDf["id"] == uid)
-        for i in range(1, nIsotopologues):
-            mz += delC  # Suppose that the tracer is 13C
+        labels = list(infoDf[infoDf["id"] == uid]["isotopologues"])
+        if len(tracers) == 2:
+            # Dual tracers (13C + 15N): "Ma,b" is searched at the m/z of M0 + a * (13C - 12C) + b * (15N - 14N),
+            # since 13C and 15N isotopologues of the same nominal mass are resolved at high resolution
+            mz0 = mz
+            for label in labels[1:]:
+                a, b = parseIsotopologue(label)
+                obsMz, obsIntensity = findPeak(spec, mz0 + a * tracerMassShift["13C"] + b * tracerMassShift["15N"],
+                                               tol)
+                mzArray.append(obsMz)
+                intensityArray.append(obsIntensity)
+                ms1Array.append(int(scanNum))
+                rtArray.append(rt)
+            labels = []
+        for i in range(1, len(labels)):
+            mz += delM  # Mass difference of the tracer (13C or 15N)
             obsMz, obsIntensity = findPeak(spec, mz, tol)
             if obsMz > 0:
                 mz = obsMz  # When an isotopologue is found, the next one will be searched from the current one
@@ -116,11 +145,55 @@ def findIsotopologue(mzxmlFile, infoDf, isRef, params):
             res["pct"].append(intensityArray / sum(intensityArray) * 100)
         else:
             res["pct"].append(intensityArray)
+        progress.update("match", name)
+    progress.finish("match", name)
 
     res = pd.DataFrame.from_dict(res)
     return res
 
 
+def confirmMS2(mzxmlFile, infoDf, library, libIds, params):
+    # MS2 confirmation of target metabolites
+    # MS2 spectra whose precursor m/z and RT are close to M0 of a target are compared to the library spectra of the target
+    # Returns a dataframe with the best MS2 similarity (and its MS2 scan) of each target
+    try:
+        tol = float(params["ms2_precursor_tolerance"])
+    except KeyError:
+        tol = 10
+    m0Df = infoDf[infoDf["isotopologues"] == "M0"]
+    if isinstance(mzxmlFile, ms1Spectra) and mzxmlFile.ms2 is not None:    # MS2 spectra read with MS1 spectra
+        ms2Specs = mzxmlFile.ms2
+    else:
+        ms2Specs = readMs2Spectra(mzxmlFile)
+    precursorMzs = np.array([spec["precursorMz"] for spec in ms2Specs])
+    ms2RTs = np.array([spec["retentionTime"] for spec in ms2Specs])
+
+    # MS2 spectra (queries) of all targets are scored against the library at once
+    queries, queryTargets = [], []
+    for uid, mz, rt in zip(m0Df["id"], m0Df["feature_m/z"], m0Df["feature_RT"]):
+        idx = np.where((abs(precursorMzs - mz) <= mz * tol / 1e6) & ((rt - 2.5) < ms2RTs) & (ms2RTs < (rt + 2.5)))[0]
+        for i in idx:
+            queries.append(ms2Specs[i])
+            queryTargets.append(uid)
+    scores = calcMS2SimilarityBatch(queries, library)
+
+    res = {"id": [], "ms2Similarity": [], "ms2Scan": []}
+    for uid in m0Df["id"]:
+        rows = [i for i, v in enumerate(queryTargets) if v == uid]
+        cols = np.where(libIds == uid)[0]
+        score, scanNum = 0, 0
+        if len(rows) > 0 and len(cols) > 0:
+            subScores = scores[rows][:, cols].toarray()
+            i, j = np.unravel_index(np.argmax(subScores), subScores.shape)
+            if subScores[i, j] > 0:
+                score, scanNum = subScores[i, j], int(queries[rows[i]]["num"])
+        res["id"].append(uid)
+        res["ms2Similarity"].append(score)
+        res["ms2Scan"].append(scanNum)
+    res = pd.DataFrame.from_dict(res)
+    return res
+
+
 def correctNaturalAbundance(df):
     # Input arguments
     # inputDf = a pandas dataframe containing the information of isotopologues and their quantity (uncorrected)
@@ -132,9 +205,20 @@ def correctNaturalAbundance(df):
     uids = df["id"].unique()
     for uid in uids:
         idx = df["id"] == uid
+        if sparse.issparse(cm[uid]):
+            # Dual tracers: the (sparse) correction matrix is factorized once and used for all samples
+            try:
+                lu = splu(cm[uid].tocsc())
+            except RuntimeError:    # Singular matrix, e.g., isotopologues without any theoretical peak
+                lu = None
         for col in cols:
             intensity = df.loc[idx][col]
-            correctedIntensity = np.dot(np.linalg.inv(cm[uid]), intensity)
+            if not sparse.issparse(cm[uid]):
+                correctedIntensity = np.dot(np.linalg.inv(cm[uid]), intensity)
+            elif lu is not None:
+                correctedIntensity = lu.solve(np.array(intensity, dtype=float))
+            else:
+                correctedIntensity = lsqr(cm[uid], np.array(intensity, dtype=float))[0]
             correctedIntensity[correctedIntensity < 0] = 0
             df.loc[idx, col] = correctedIntensity
             if sum(correctedIntensity) == 0:
@@ -152,6 +236,18 @@ def correctionMatrix(df):
     for uid in uids:
         subDf = df[df["id"] == uid]
         n = subDf.shape[0]
+        if subDf["isotopologues"].str.contains(",").any():
+            # Dual tracers (13C + 15N): (nC + 1) x (nN + 1) isotopologues, but each of them has only a few
+            # non-zero fractions, so the correction matrix is kept as a sparse matrix
+            rows, cols, values = [], [], []
+            for i in range(n):
+                intensity = np.array(subDf.iloc[i]["isotope_intensity"].split(";"), dtype=float) / 100
+                j = np.nonzero(intensity)[0]
+                rows.extend(j)
+                cols.extend([i] * len(j))
+                values.extend(intensity[j])
+            res[uid] = sparse.csr_matrix((values, (rows, cols)), shape=(n, n))
+            continue
         cm = np.zeros((n, n))
         for i in range(n):
             # Assume that "intensity" is already sorted and organized from M0 to Mn
@@ -221,7 +317,7 @@ if __name__ == "__main__":
     #    - Parameters for calculating theoretical natural abundances of target metabolitesList of target metabolites
     #    - Experimental conditions including a tracer, MS mode (pos or neg), etc.
     # 2.
-    # 3. List of mzXML files
+    # 3. List of mzXML (or mzML, optionally gzip-compressed) files
 
     paramFile = sys.argv[1]
     # paramFile = "jumpm_targeted.params"
@@ -238,7 +334,10 @@ if __name__ == "__main__":
         #     r"C:\Users\jcho\OneDrive - St. Jude Children's Research Hospital\UDrive\Research\Projects\7Metabolomics\Datasets\13Ctracer_rawdata\9_tracer.mzXML"]
 
         if len(mzxmlFiles) == 0:
-            sys.exit("  You should specify mzXML files\n  e.g., jump -mpython -target jumpm_targeted.params test1.mzXML test2.mzXML ...")
+            sys.exit("  You should specify mzXML (or mzML) files\n  e.g., jump -mpython -target jumpm_targeted.params test1.mzXML test2.mzXML ...")
+
+        # Throughput and ETA of decoding scans, matching targets and computing isotopic distributions
+        progress.configure(params)
 
         # Calculation of theoretical isotopic distributions (Surendhar's script)
         refInfoFile = params["ref_feature_information"]  # JUMPm result of the reference run
@@ -246,21 +345,96 @@ if __name__ == "__main__":
         infoDf = getIsotopicDistributions(paramFile, refInfoFile)
         infoDf = refDf.merge(infoDf, left_on="name", right_on="name")
         res = infoDf.copy()
-        isoDf = {}
+
+        # When "streaming = 1", the result of each file is written to an on-disk store as soon as the file is processed
+        # (instead of being kept in memory until all files are done)
+        # When "incremental = 1", the store is also used as a cache, i.e., only new or modified files are processed
+        # and the cached results of the other files are reused
+        isStreaming, isIncremental = 0, 0
+        if "streaming" in params and params["streaming"] == "1":
+            isStreaming = 1
+        if "incremental" in params and params["incremental"] == "1":
+            isStreaming, isIncremental = 1, 1
+        if isStreaming == 1:
+            try:
+                storeDir = params["result_store"]
+            except KeyError:
+                storeDir = "tracer_result_store"
+            store = resultStore(storeDir)
+            targets = targetHash(infoDf, params)
+            useContentHash = 0
+            if "cache_content_hash" in params and params["cache_content_hash"] == "1":
+                useContentHash = 1
+        # Files to be processed (files whose results can be reused are skipped when "incremental = 1")
+        isRef, identity, runFiles = {}, {}, []
         for mzxmlFile in mzxmlFiles:
-            print("  Working on {}".format(os.path.basename(mzxmlFile)))
             if os.path.basename(mzxmlFile) == params["ref_run"]:
-                isRef = 1
+                isRef[mzxmlFile] = 1
+            else:
+                isRef[mzxmlFile] = 0
+            if isStreaming == 1:
+                identity[mzxmlFile] = fileIdentity(mzxmlFile, useContentHash)
+                identity[mzxmlFile]["isRef"] = isRef[mzxmlFile]
+                if isIncremental == 1 and store.isCurrent(os.path.basename(mzxmlFile), identity[mzxmlFile], targets):
+                    print("  Reusing the result of {}".format(os.path.basename(mzxmlFile)))
+                    continue
+            runFiles.append(mzxmlFile)
+
+        # Spectra of the next file(s) are read and decoded in the background while the current file is processed
+        # "prefetch_files" = the number of files read ahead (0 = no prefetch)
+        try:
+            nPrefetch = int(params["prefetch_files"])
+        except KeyError:
+            nPrefetch = 1
+        # MS1 scans of a (indexed) mzXML file are decoded by "decoding_workers" processes in parallel
+        try:
+            nWorkers = int(params["decoding_workers"])
+        except KeyError:
+            nWorkers = 1
+        # Optional MS2 confirmation of target metabolites using a spectral library (MGF file)
+        # MS2 spectra are read in the same pass as MS1 spectra, and the result of each run is stored (and reused)
+        # together with its isotopologues
+        isMS2 = 0
+        if "ms2_library" in params and params["ms2_library"] != "":
+            isMS2 = 1
+            print("  MS2 spectra of target metabolites are compared to the library")
+            library, libIds = readMS2Library(params["ms2_library"])
+        isoDf, ms2Res = {}, {}
+        for mzxmlFile, spectra in prefetchSpectra(runFiles, nPrefetch, nWorkers, isMS2 == 1):
+            progress.log("  Working on {}".format(os.path.basename(mzxmlFile)))
+            df = findIsotopologue(spectra, infoDf, isRef[mzxmlFile], params)
+            runMS2Df = None
+            if isMS2 == 1:
+                runMS2Df = confirmMS2(spectra, infoDf, library, libIds, params)
+            del spectra     # Released before the next file is handed over
+            if isStreaming == 1:
+                store.append(os.path.basename(mzxmlFile), df, identity[mzxmlFile], targets, runMS2Df)
             else:
-                isRef = 0
-            df = findIsotopologue(mzxmlFile, infoDf, isRef, params)
-            isoDf[os.path.basename(mzxmlFile)] = df
+                isoDf[os.path.basename(mzxmlFile)] = df
+                ms2Res[os.path.basename(mzxmlFile)] = runMS2Df
         res = res[["id", "formula", "name", "feature_ion", "feature_z", "isotopologues", "isotope_m/z", "isotope_intensity"]]
         res = res.rename(columns={"feature_ion": "ion", "feature_z": "charge"})
 
+        # Output of the MS2 confirmation
+        if isMS2 == 1:
+            ms2Df = res[res["isotopologues"] == "M0"][["id", "name"]].reset_index(drop=True)
+            for mzxmlFile in mzxmlFiles:
+                if isStreaming == 1:
+                    df = store.loadMS2(os.path.basename(mzxmlFile))
+                else:
+                    df = ms2Res[os.path.basename(mzxmlFile)]
+                key = os.path.basename(mzxmlFile).split(".")[0]
+                ms2Df[key + "_ms2Similarity"] = df["ms2Similarity"]
+                ms2Df[key + "_ms2Scan"] = df["ms2Scan"]
+            ms2Df.to_csv("tracer_ms2_confirmation.txt", sep="\t", index=False)
+
         # Format the output dataframe
-        res = formatOutput(res, isoDf)
-        res.to_csv("tracer_result.txt", sep="\t", index=False)
+        if isStreaming == 1:
+            store.writeTable(res, [os.path.basename(f) for f in mzxmlFiles], "tracer_result.txt")
+        else:
+            res = formatOutput(res, isoDf)
+            res.to_csv("tracer_result.txt", sep="\t", index=False)
+        progress.close()
 
     # Mode 2, correction of natural abundances of isotopic peaks (of quantified isotopologues)
     elif params["mode"] == "2":
@@ -275,8 +449,13 @@ if __name__ == "__main__":
             sys.exit("  'Please check 'quan_result' parameter whether the file path is correctly specified")
         res = correctNaturalAbundance(df)
         res.to_csv("tracer_corrected_result.txt", sep="\t", index=False)
+
+    # Mode 3, local service answering targeted queries from loaded runs and computed distributions (kept in memory)
+    elif params["mode"] == "3":
+        print("  Targeted queries are answered by a local service")
+        runService(params, findIsotopologue)
     else:
-        sys.exit("The parameter 'mode' should be properly set (either 1 or 2)")
+        sys.exit("The parameter 'mode' should be properly set (1, 2 or 3)")
 
     print()
     endTime = datetime.now()
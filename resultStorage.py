@@ -0,0 +1,203 @@
+import os, json, shutil, hashlib, numpy as np, pandas as pd
+
+
+def valueKind(v):
+    # Type of a value as written to the output, 0 = float64 (or float), 1 = float32, 2 = integer
+    if isinstance(v, np.float32):
+        return 1
+    elif isinstance(v, (int, np.integer)):
+        return 2
+    else:
+        return 0
+
+
+kindTypes = {0: np.float64, 1: np.float32, 2: np.int64}
+
+
+def columnArray(values, defaultType):
+    # Convert a list of values (a column of an exploded result dataframe) to a numpy array
+    # Returns (array, kinds)
+    # - When all values are of the same type (e.g., float32 intensities decoded from mzXML), the array has that type
+    #   and kinds = None
+    # - Otherwise (e.g., observed float32 m/z mixed with float64 theoretical m/z of not-found isotopologues,
+    #   or float32 intensities mixed with integer 0), the array is float64 (which holds all of them exactly) and
+    #   kinds = the type of each value (see "valueKind"), so that each value is written to the output in the same way
+    #   as the in-memory mode
+    if len(values) == 0:
+        return np.array([], dtype=defaultType), None
+    kinds = np.array([valueKind(v) for v in values], dtype=np.int8)
+    if np.all(kinds == kinds[0]):
+        return np.array(values, dtype=kindTypes[int(kinds[0])]), None
+    return np.array(values, dtype=np.float64), kinds
+
+
+def columnValues(values, kinds):
+    # Restore the values of a column (from "columnArray") with their original types
+    if kinds is None:
+        return values
+    res = np.empty(len(values), dtype=object)
+    for kind, dtype in kindTypes.items():
+        idx = np.where(kinds == kind)[0]
+        if kind == 2:
+            res[idx] = [int(v) for v in values[idx]]
+        else:
+            res[idx] = [dtype(v) for v in values[idx]]
+    return res
+
+
+def fileIdentity(path, useContentHash=0):
+    # Identity of an input file, used to decide whether its cached result can be reused
+    # By default, a file is regarded as unchanged when its path, size and modification time are the same
+    # When "useContentHash = 1", a file is regarded as unchanged when its size and SHA-1 of the content are the same
+    # regardless of its path and modification time (slower, but robust to copies and touches)
+    stat = os.stat(path)
+    if useContentHash == 1:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        return {"size": stat.st_size, "sha1": sha1.hexdigest()}
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def targetHash(infoDf, params):
+    # Hash of the target metabolites (and their isotopologues) and the tolerances used for finding isotopologues
+    # When the MS2 confirmation is used, the MS2 library (and the precursor tolerance) are also included
+    # Any change of them invalidates all cached results
+    sha1 = hashlib.sha1()
+    sha1.update(infoDf[["id", "isotopologues", "feature_m/z", "feature_RT"]].to_csv(index=False).encode())
+    for key in ["ms1_tolerance", "Tracer_1", "Tracer_2"]:
+        if key in params:
+            sha1.update("{}={};".format(key, params[key]).encode())
+    if "ms2_library" in params and params["ms2_library"] != "":
+        sha1.update("ms2_library={};".format(json.dumps(fileIdentity(params["ms2_library"]))).encode())
+        if "ms2_precursor_tolerance" in params:
+            sha1.update("ms2_precursor_tolerance={};".format(params["ms2_precursor_tolerance"]).encode())
+    return sha1.hexdigest()
+
+
+class resultStore:
+    # On-disk columnar store of the per-file (per-run) results of mode 1
+    # Each run is written as soon as its isotopologues are quantified, one .npy file per column, i.e.,
+    #   <storeDir>/<run>/mz.npy
+    #   <storeDir>/<run>/ms1.npy
+    #   <storeDir>/<run>/rt.npy
+    #   <storeDir>/<run>/intensity.npy
+    #   <storeDir>/<run>/pct.npy
+    #   <storeDir>/<run>/ms2Similarity.npy, ms2Scan.npy (one value per metabolite, when the MS2 confirmation is used)
+    # and "manifest.json" keeps the list of stored runs. The final (wide) table is assembled by reading
+    # a block of rows of each column at a time, so the memory usage does not grow with the number of runs
+    # The manifest also keeps the identity of the input file and the hash of targets of each run,
+    # so that the store can be used as a cache of per-run results (i.e., incremental processing)
+    columns = {"mz": np.float64, "ms1": np.int64, "rt": np.float64, "intensity": np.float64, "pct": np.float64}
+    ms2Columns = {"ms2Similarity": np.float64, "ms2Scan": np.int64}
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.manifestFile = os.path.join(storeDir, "manifest.json")
+        os.makedirs(storeDir, exist_ok=True)
+        if os.path.exists(self.manifestFile):
+            with open(self.manifestFile, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"runs": {}}
+
+    def saveManifest(self):
+        # Write to a temporary file first, so that the manifest is never left half-written
+        tmpFile = self.manifestFile + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmpFile, self.manifestFile)
+
+    def runDir(self, key):
+        return os.path.join(self.storeDir, key)
+
+    def isCurrent(self, key, identity, targets):
+        # Check whether the stored result of a run was obtained from the same input file and the same targets
+        if key not in self.manifest["runs"]:
+            return False
+        run = self.manifest["runs"][key]
+        if "identity" not in run or "targets" not in run:
+            return False
+        return run["identity"] == identity and run["targets"] == targets
+
+    def append(self, key, df, identity=None, targets=None, ms2Df=None):
+        # Input arguments
+        # key = name of a run (i.e., basename of a mzXML file)
+        # df = a dataframe from "findIsotopologue" (one row per metabolite, lists of M0, M1, ..., Mn in each column)
+        # identity = identity of the input file (from "fileIdentity"), optional
+        # targets = hash of the target metabolites (from "targetHash"), optional
+        # ms2Df = a dataframe from "confirmMS2" (one row per metabolite), optional
+        df = df.set_index(["id"]).apply(pd.Series.explode).reset_index()
+        tmpDir = self.runDir(key) + ".tmp"
+        if os.path.exists(tmpDir):
+            shutil.rmtree(tmpDir)
+        os.makedirs(tmpDir)
+        for col, defaultType in self.columns.items():
+            values, kinds = columnArray(list(df[col]), defaultType)
+            np.save(os.path.join(tmpDir, col + ".npy"), values)
+            if kinds is not None:
+                np.save(os.path.join(tmpDir, col + ".kind.npy"), kinds)
+        if ms2Df is not None:
+            for col, dtype in self.ms2Columns.items():
+                np.save(os.path.join(tmpDir, col + ".npy"), np.array(ms2Df[col], dtype=dtype))
+        if os.path.exists(self.runDir(key)):
+            shutil.rmtree(self.runDir(key))
+        os.replace(tmpDir, self.runDir(key))
+        self.manifest["runs"][key] = {"rows": int(df.shape[0]), "ms2": ms2Df is not None}
+        if identity is not None and targets is not None:
+            self.manifest["runs"][key]["identity"] = identity
+            self.manifest["runs"][key]["targets"] = targets
+        self.saveManifest()
+
+    def load(self, key, col, start=None, end=None):
+        # Memory-mapped, so that only the requested rows are actually read from the disk
+        # When "start" and "end" are given, the rows are returned with the original types of values
+        values = np.load(os.path.join(self.runDir(key), col + ".npy"), mmap_mode="r")
+        if start is None:
+            return values
+        kindFile = os.path.join(self.runDir(key), col + ".kind.npy")
+        if os.path.exists(kindFile):
+            return columnValues(np.array(values[start:end]), np.load(kindFile, mmap_mode="r")[start:end])
+        return np.array(values[start:end])
+
+    def loadMS2(self, key):
+        # Result of the MS2 confirmation of a run (a dataframe with "ms2Similarity" and "ms2Scan" columns)
+        if not self.manifest["runs"].get(key, {}).get("ms2", False):
+            raise KeyError("The MS2 confirmation result of {} is not found in the result store {}".format(key, self.storeDir))
+        return pd.DataFrame({col: np.array(self.load(key, col)) for col in self.ms2Columns.keys()})
+
+    def writeTable(self, res, keys, outputFile, chunkSize=10000):
+        # Input arguments
+        # res = a dataframe containing the information of isotopologues (one row per isotopologue)
+        # keys = names of runs to be written (in the order of columns)
+        # outputFile = path of the output (tab-delimited) file
+        # The output is the same as that of "formatOutput" followed by "to_csv"
+        n = res.shape[0]
+        for key in keys:
+            if key not in self.manifest["runs"]:
+                raise KeyError("{} is not found in the result store {}".format(key, self.storeDir))
+            if self.manifest["runs"][key]["rows"] != n:
+                raise ValueError("The number of isotopologues of {} in the result store does not match "
+                                 "the current target metabolites".format(key))
+
+        for start in range(0, max(n, 1), chunkSize):
+            end = min(start + chunkSize, n)
+            chunk = res.iloc[start:end].reset_index(drop=True)
+            # Columns of all runs are collected first, and then the strings of observed m/z, MS1 scans and RTs
+            # (e.g., "179.05576;179.05573;...") and the intensity/percentage dataframes are made at once
+            obs = {"mz": [], "ms1": [], "rt": []}
+            intensities, pcts = {}, {}
+            for key in keys:
+                for col in obs.keys():
+                    obs[col].append(self.load(key, col, start, end))
+                intensities[key.split(".")[0] + "_intensity"] = self.load(key, "intensity", start, end)
+                pcts[key.split(".")[0] + "_labelingPct"] = self.load(key, "pct", start, end)
+            for col, name in [("mz", "observed_m/z"), ("ms1", "MS1scan"), ("rt", "RT")]:
+                chunk[name] = np.array([";".join([str(v) for v in values]) for values in zip(*obs[col])],
+                                       dtype=object)
+            chunk = pd.concat([chunk, pd.DataFrame(intensities), pd.DataFrame(pcts)], axis=1)
+            if start == 0:
+                chunk.to_csv(outputFile, sep="\t", index=False)
+            else:
+                chunk.to_csv(outputFile, sep="\t", index=False, header=False, mode="a")
@@ -0,0 +1,225 @@
+import os, re, json, math, threading, pandas as pd
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from isotopeCalculation import getElementDistributions, getCompoundDistributions
+from spectrumSource import ms1Spectra, getFormat
+
+
+class invalidRequest(Exception):
+    # A request with missing or invalid fields (answered with 400; any other error is answered with 500)
+    pass
+
+
+class targetedService:
+    # Resident state of the service mode
+    # - MS1 spectra of loaded runs (at most "maxRuns" runs, least recently used runs are evicted)
+    # - Isotopic distributions of elements (including tracer elements)
+    # - Theoretical isotopic distributions of compounds, computed once per (formula, ion, charge)
+    def __init__(self, params, findIsotopologue):
+        self.params = params
+        self.findIsotopologue = findIsotopologue
+        try:
+            self.maxRuns = int(params["service_max_runs"])
+        except KeyError:
+            self.maxRuns = 10
+        try:
+            self.nWorkers = int(params["decoding_workers"])
+        except KeyError:
+            self.nWorkers = 1
+        self.runs = OrderedDict()
+        self.distributions = {}
+        self.loading = {}   # Runs and distributions being loaded (computed), {key: future}
+        self.lock = threading.Lock()
+        self.elementDistributions = getElementDistributions(params)
+
+    def getOrLoad(self, cache, key, load, maxSize=None):
+        # Return cache[key], or load it by "load()" outside the lock, so that a long loading (e.g., decoding a run)
+        # does not block the other requests; concurrent requests of the same key wait for the same loading
+        with self.lock:
+            if key in cache:
+                if maxSize is not None:
+                    cache.move_to_end(key)
+                return cache[key]
+            if key in self.loading:
+                future, isOwner = self.loading[key], False
+            else:
+                future, isOwner = Future(), True
+                self.loading[key] = future
+        if not isOwner:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as e:
+            with self.lock:
+                self.loading.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.loading.pop(key, None)
+            cache[key] = value
+            if maxSize is not None:
+                while len(cache) > maxSize:
+                    cache.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def getRun(self, path):
+        path = os.path.abspath(path)
+        return self.getOrLoad(self.runs, path, lambda: ms1Spectra(path, self.nWorkers), self.maxRuns)
+
+    def unloadRun(self, path):
+        with self.lock:
+            self.runs.pop(os.path.abspath(path), None)
+
+    def getDistribution(self, formula, ion, z):
+        return self.getOrLoad(self.distributions, (formula, ion, z),
+                              lambda: getCompoundDistributions(self.elementDistributions, formula, ion, z, self.params))
+
+    def status(self):
+        with self.lock:
+            return {"runs": list(self.runs.keys()), "maxRuns": self.maxRuns,
+                    "loading": [key for key in self.loading.keys() if isinstance(key, str)],
+                    "distributions": ["{} {} (z = {})".format(*key) for key in self.distributions.keys()]}
+
+    def checkFiles(self, request, checkExistence=True):
+        # "files" = list of paths of (existing, when "checkExistence = True") mzXML or mzML files
+        files = request.get("files")
+        if not isinstance(files, list) or not all(isinstance(path, str) for path in files):
+            raise invalidRequest("'files' should be a list of paths")
+        if not checkExistence:
+            return files
+        for path in files:
+            try:
+                getFormat(path)
+            except ValueError as e:
+                raise invalidRequest(str(e))
+            if not os.path.isfile(path):
+                raise invalidRequest("File not found, {}".format(path))
+        return files
+
+    def checkQuery(self, request):
+        # Fields of a "/quantify" request, checked before any work is started
+        formula = request.get("formula")
+        if not isinstance(formula, str) or not re.fullmatch(r"([A-Z][a-z]?\d*)+", formula):
+            raise invalidRequest("'formula' should be a chemical formula, e.g., C6H12O6")
+        for element in re.findall(r"[A-Z][a-z]?", formula):
+            if element not in self.elementDistributions or element in ("x", "y"):
+                raise invalidRequest("Unknown element in 'formula', {}".format(element))
+        ion = request.get("ion", "[M-H]-")
+        if not isinstance(ion, str) or ion[-1:] not in ("+", "-"):
+            raise invalidRequest("'ion' should end with + or -, e.g., [M-H]-")
+        try:
+            z = int(request.get("charge", 1))
+            mz, rt = float(request["mz"]), float(request["rt"])
+        except KeyError as e:
+            raise invalidRequest("{} is required".format(e))
+        except (ValueError, TypeError):
+            raise invalidRequest("'mz' and 'rt' should be numbers and 'charge' should be an integer")
+        if z < 1 or not math.isfinite(mz) or not math.isfinite(rt) or mz <= 0:
+            raise invalidRequest("'mz' should be positive, 'rt' finite and 'charge' a positive integer")
+        return formula, ion, z, mz, rt, self.checkFiles(request)
+
+    def quantify(self, request):
+        # Input arguments (a dictionary from a JSON request)
+        # formula = chemical formula of a target metabolite, e.g., "C6H12O6"
+        # mz, rt = m/z and RT (min) of the monoisotopic peak (M0) of the target in the reference run
+        # files = list of runs (mzXML or mzML) to be quantified; runs are loaded when they are not loaded yet
+        # ion, charge = optional, e.g., "[M-H]-" and 1 (default)
+        # id, ref_run = optional, id of the target and the name of the reference run (default = "ref_run" parameter)
+        formula, ion, z, mz, rt, files = self.checkQuery(request)
+        uid = request.get("id", formula)
+        refRun = request.get("ref_run", self.params.get("ref_run"))
+
+        rows = self.getDistribution(formula, ion, z)
+        infoDf = pd.DataFrame(rows)
+        infoDf["id"] = uid
+        infoDf["feature_m/z"] = mz
+        infoDf["feature_RT"] = rt
+        res = {"id": uid, "formula": formula, "ion": ion, "charge": z,
+               "isotopologues": list(infoDf["isotopologues"]),
+               "isotope_m/z": list(infoDf["isotope_m/z"]),
+               "isotope_intensity": list(infoDf["isotope_intensity"]),
+               "runs": {}}
+        for path in files:
+            if os.path.basename(path) == refRun:
+                isRef = 1
+            else:
+                isRef = 0
+            df = self.findIsotopologue(self.getRun(path), infoDf, isRef, self.params)
+            res["runs"][os.path.basename(path)] = {"mz": [float(v) for v in df.iloc[0]["mz"]],
+                                                   "intensity": [float(v) for v in df.iloc[0]["intensity"]],
+                                                   "pct": [float(v) for v in df.iloc[0]["pct"]],
+                                                   "ms1": [int(v) for v in df.iloc[0]["ms1"]],
+                                                   "rt": [float(v) for v in df.iloc[0]["rt"]]}
+        return res
+
+
+class serviceHandler(BaseHTTPRequestHandler):
+    # GET /status = loaded runs and computed distributions
+    # POST /load {"files": [...]} = load (decode) runs in advance
+    # POST /unload {"files": [...]} = release runs
+    # POST /quantify {"formula", "mz", "rt", "files", ...} = quantify isotopologues of a target in the runs
+    service = None
+
+    def sendJson(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.sendJson(200, self.service.status())
+        else:
+            self.sendJson(404, {"error": "Unknown request, {}".format(self.path)})
+
+    def do_POST(self):
+        # Requests are validated before any work is started, so that errors raised while working (i.e., bugs or
+        # broken input files) are reported as server errors (500), not as invalid requests (400)
+        try:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as e:
+                raise invalidRequest("Request body should be JSON, {}".format(e))
+            if not isinstance(request, dict):
+                raise invalidRequest("Request body should be a JSON object")
+            if self.path == "/quantify":
+                self.sendJson(200, self.service.quantify(request))
+            elif self.path == "/load":
+                for path in self.service.checkFiles(request):
+                    self.service.getRun(path)
+                self.sendJson(200, self.service.status())
+            elif self.path == "/unload":
+                for path in self.service.checkFiles(request, checkExistence=False):
+                    self.service.unloadRun(path)
+                self.sendJson(200, self.service.status())
+            else:
+                self.sendJson(404, {"error": "Unknown request, {}".format(self.path)})
+        except invalidRequest as e:
+            self.sendJson(400, {"error": "Invalid request, {}".format(e)})
+        except Exception as e:
+            self.sendJson(500, {"error": repr(e)})
+
+    def log_message(self, format, *args):
+        return
+
+
+def runService(params, findIsotopologue):
+    # Local (localhost only) HTTP service answering targeted queries from warm (in-memory) state
+    try:
+        port = int(params["service_port"])
+    except KeyError:
+        port = 8765
+    serviceHandler.service = targetedService(params, findIsotopologue)
+    server = ThreadingHTTPServer(("127.0.0.1", port), serviceHandler)
+    print("  Service is running at http://127.0.0.1:{} (Ctrl+C to stop)".format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,470 @@
+import os, re, io, gzip, base64, zlib, numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pyteomics import mzxml, mzml
+from pyteomics.xml import XMLValueConverter
+from utils import progress, initProgress
+
+
+def getFormat(path):
+    # Format of a spectrum file determined by its extension
+    # e.g., "run1.mzXML" -> ("mzxml", False), "run1.mzML.gz" -> ("mzml", True)
+    name = path.lower()
+    isCompressed = name.endswith(".gz")
+    if isCompressed:
+        name = name[:-3]
+    if name.endswith(".mzxml"):
+        return "mzxml", isCompressed
+    elif name.endswith(".mzml"):
+        return "mzml", isCompressed
+    else:
+        raise ValueError("Unsupported format of the spectrum file, {} (mzXML or mzML is supported)".format(path))
+
+
+msLevelPattern = re.compile(rb'accession="MS:1000511"[^>]*value="(\d+)"')
+
+
+def isIndexedMzml(source):
+    # Indexed mzML has the offsets of spectra at the end of the file (<indexedmzML> is the root element)
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            head = f.read(1024)
+    else:
+        head = source.read(1024)
+        source.seek(0)
+    return b"<indexedmzML" in head
+
+
+def getScanInfo(spec, fmt):
+    # Returns (native id, scan number, MS level, RT in minute) of a spectrum
+    if fmt == "mzxml":
+        return spec["num"], spec["num"], int(spec["msLevel"]), float(spec["retentionTime"])
+    else:
+        rt = spec["scanList"]["scan"][0]["scan start time"]
+        if getattr(rt, "unit_info", None) == "second":
+            rt = rt / 60
+        match = re.search(r"scan=(\d+)", spec["id"])
+        if match:
+            num = match.group(1)
+        else:
+            num = str(spec["index"] + 1)
+        return spec["id"], num, int(spec["ms level"]), float(rt)
+
+
+mzxmlAttrPattern = re.compile(rb'\s(\w+)="([^"]*)"')
+mzxmlPeaksPattern = re.compile(rb"<peaks\s([^>]*?)(/?)>")
+mzxmlPrecursorPattern = re.compile(rb"<precursorMz[^>]*>\s*([^<\s]+)\s*</precursorMz>")
+
+
+scanCountPattern = re.compile(rb'<msRun\s[^>]*?scanCount="(\d+)"|<spectrumList\s[^>]*?count="(\d+)"')
+
+
+def readScanCount(source):
+    # Number of scans (spectra) of a run given in its header, i.e., <msRun scanCount="..."> (mzXML) or
+    # <spectrumList count="..."> (mzML), or None when it is not found in the first 1 MB
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            head = f.read(1 << 20)
+    else:
+        head = source.getbuffer()[:1 << 20].tobytes()
+    match = scanCountPattern.search(head)
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+
+def readMzxmlIndex(path):
+    # Read the scan offset index at the end of a mzXML file
+    # Returns a list of (scan number, byte offset) sorted by offset, or None if the file has no (valid) index
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 4096))
+        match = re.search(rb"<indexOffset>\s*(\d+)\s*</indexOffset>", f.read())
+        if match is None or int(match.group(1)) >= size:
+            return None
+        f.seek(int(match.group(1)))
+        text = f.read()
+    if not text.startswith(b"<index"):
+        return None
+    text = text[:text.find(b"</index>")]
+    offsets = [(num.decode(), int(offset)) for num, offset in re.findall(rb'<offset\s+id="(\d+)"\s*>(\d+)</offset>', text)]
+    if len(offsets) == 0:
+        return None
+    return sorted(offsets, key=lambda x: x[1])
+
+
+def readMzxmlHeader(f, start, end):
+    # Attributes of <scan> and <peaks> elements of a scan starting at the byte offset "start"
+    # (and the byte offset of the encoded peaks), read without reading/decoding the peaks
+    # The precursor m/z of a MS2 scan (if any) is included in the attributes of <scan> (key = b"precursorMz")
+    blockSize = 2048
+    text = b""
+    while True:
+        f.seek(start + len(text))
+        block = f.read(min(blockSize, end - start - len(text)))
+        text += block
+        match = mzxmlPeaksPattern.search(text)
+        if match or len(block) == 0:
+            break
+        blockSize *= 2
+    if not text.startswith(b"<scan"):
+        raise ValueError("Offset index of the mzXML file does not point to a scan")
+    scan = dict(mzxmlAttrPattern.findall(text[:text.find(b">")]))
+    precursor = mzxmlPrecursorPattern.search(text, 0, match.start() if match else len(text))
+    if precursor:
+        scan[b"precursorMz"] = precursor.group(1)
+    if match is None:   # No peaks (e.g., a scan without <peaks> element)
+        return scan, {}, -1
+    peaks = dict(mzxmlAttrPattern.findall(b" " + match.group(1)))
+    if match.group(2) == b"/":  # <peaks ... /> (empty)
+        return scan, peaks, -1
+    return scan, peaks, start + match.end()
+
+
+def decodeMzxmlPeaks(path, chunk, shmNames, dtype, nTotal):
+    # Worker function of the parallel decoding; decodes the peaks of a chunk of MS1 scans (a contiguous byte range)
+    # and writes them to the shared arrays
+    # chunk = list of (byte offset of the encoded peaks, number of peaks, position in the shared arrays,
+    #                  precision, byte order, compression type)
+    shmMz = shared_memory.SharedMemory(name=shmNames[0])
+    shmIntensity = shared_memory.SharedMemory(name=shmNames[1])
+    try:
+        mzArray = np.ndarray((nTotal,), dtype=dtype, buffer=shmMz.buf)
+        intensityArray = np.ndarray((nTotal,), dtype=dtype, buffer=shmIntensity.buf)
+        chunkStart = chunk[0][0]
+        with open(path, "rb") as f:
+            f.seek(chunkStart)
+            nBytes = chunk[-1][0] - chunkStart
+            text = f.read(nBytes)
+            # The encoded peaks of the last scan are read up to the closing tag
+            tail = b""
+            while tail.find(b"</peaks>") < 0:
+                block = f.read(1 << 20)
+                if len(block) == 0:
+                    break
+                tail += block
+            text += tail[:tail.find(b"</peaks>") + len("</peaks>")]
+        for dataStart, n, pos, precision, byteOrder, compression in chunk:
+            if n == 0:
+                continue
+            i = dataStart - chunkStart
+            data = base64.b64decode(text[i:text.find(b"</peaks>", i)])
+            if compression == "zlib":
+                data = zlib.decompress(data)
+            if byteOrder in ("network", "big"):
+                order = ">"
+            else:
+                order = "<"
+            if precision == "64":
+                peaks = np.frombuffer(data, dtype=order + "f8")
+            else:
+                peaks = np.frombuffer(data, dtype=order + "f4")
+            mzArray[pos:pos + n] = peaks[0::2]
+            intensityArray[pos:pos + n] = peaks[1::2]
+            progress.update("decode", os.path.basename(path))
+        progress.flush()
+    finally:
+        shmMz.close()
+        shmIntensity.close()
+
+
+def getPrecursorMz(spec, fmt):
+    # Precursor m/z of a MS2 spectrum, or None when there is no precursor information
+    try:
+        if fmt == "mzxml":
+            return float(spec["precursorMz"][0]["precursorMz"])
+        else:
+            return float(spec["precursorList"]["precursor"][0]["selectedIonList"]["selectedIon"][0]
+                         ["selected ion m/z"])
+    except (KeyError, IndexError):
+        return None
+
+
+class ms1Spectra:
+    # MS1 spectra of a run (mzXML, mzML or their gzip-compressed files), decoded into arrays
+    # The spectra are accessed in the same way regardless of the file format, i.e.,
+    #   spectra.scans = list of MS1 scan numbers (str)
+    #   spectra.rts = numpy array of retention times (min) of MS1 scans
+    #   spectra[scanNum] = {"num", "msLevel", "retentionTime", "m/z array", "intensity array"}
+    #   for spec in spectra: ... (MS1 spectra in the order of scans)
+    # Peaks of all MS1 scans are kept in two concatenated arrays, "mz" and "intensity",
+    # and the peaks of i-th scan are mz[offsets[i]:offsets[i + 1]] (and intensity[offsets[i]:offsets[i + 1]])
+    # When "nWorkers > 1", MS1 scans of an (uncompressed and indexed) mzXML file are decoded in parallel
+    # When "readMs2 = True", MS2 spectra (having precursor information) are also collected in the same pass, i.e.,
+    #   spectra.ms2 = list of {"num", "retentionTime", "precursorMz", "mz", "intensity"} (same as "readMs2Spectra")
+    def __init__(self, path, nWorkers=1, readMs2=False):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.readMs2 = readMs2
+        self.ms2 = None
+        if readMs2:
+            self.ms2 = []
+        fmt, isCompressed = getFormat(path)
+        index = None
+        if fmt == "mzxml" and not isCompressed and (nWorkers > 1 or progress.mode is not None):
+            index = readMzxmlIndex(path)
+        if index is not None and nWorkers > 1:
+            try:
+                self.readParallel(index, nWorkers)
+                progress.finish("decode", self.name)
+                return
+            except ValueError:
+                # The offset index is present but does not match the scans (e.g., the file was edited
+                # after indexing); the file is read sequentially instead
+                index = None
+        if index is not None:
+            progress.start("decode", self.name, len(index), "scans")
+
+        # A compressed file is decompressed into the memory once, since random access to a gzip stream is slow
+        if isCompressed:
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+            source = io.BytesIO(data)
+        else:
+            source = path
+
+        # Choose the fastest way of reading MS1 spectra
+        # - indexed mzML: only MS1 spectra are parsed and decoded by direct access using the offset index
+        #   at the end of the file
+        # - mzXML and non-indexed mzML: all scans are read sequentially (and MS1 spectra are kept)
+        if fmt == "mzml" and isIndexedMzml(source):
+            scans, rts, mzs, ints = self.readIndexed(source)
+        else:
+            if index is None and progress.mode is not None:
+                # Compressed or non-indexed files; the number of scans in the header is used for the ETA
+                progress.start("decode", self.name, readScanCount(source), "scans")
+            scans, rts, mzs, ints = self.readSequential(source, fmt)
+        self.setArrays(scans, rts, mzs, ints)
+        progress.finish("decode", self.name)
+
+    def readSequential(self, source, fmt):
+        scans, rts, mzs, ints = [], [], [], []
+        if fmt == "mzxml":
+            reader = mzxml.MzXML(source, use_index=False)
+        else:
+            reader = mzml.MzML(source, use_index=False)
+        with reader:
+            for spec in reader:
+                _, num, msLevel, rt = getScanInfo(spec, fmt)
+                if msLevel == 1:
+                    scans.append(num)
+                    rts.append(rt)
+                    mzs.append(spec["m/z array"])
+                    ints.append(spec["intensity array"])
+                elif msLevel == 2 and self.readMs2:
+                    self.addMs2(spec, fmt, num, rt)
+                progress.update("decode", self.name)
+        return scans, rts, mzs, ints
+
+    def readIndexed(self, source):
+        scans, rts, mzs, ints = [], [], [], []
+        if isinstance(source, str):
+            raw = open(source, "rb")
+        else:
+            raw = io.BytesIO(source.getvalue())   # Shares the decompressed data (no copy)
+        with raw, mzml.PreIndexedMzML(source) as reader:
+            # MS level of each spectrum is looked up from the raw text at its offset, which is much faster than
+            # parsing the spectrum, so that only MS1 (and MS2 when "readMs2 = True") spectra are parsed and decoded
+            progress.start("decode", self.name, len(reader.index["spectrum"]), "scans")
+            for specId, offset in reader.index["spectrum"].items():
+                progress.update("decode", self.name)
+                raw.seek(offset)
+                head = raw.read(4096)
+                match = msLevelPattern.search(head)
+                if match and int(match.group(1)) != 1 and not (self.readMs2 and int(match.group(1)) == 2):
+                    continue
+                spec = reader.get_by_id(specId)
+                _, num, msLevel, rt = getScanInfo(spec, "mzml")
+                if msLevel == 1:
+                    scans.append(num)
+                    rts.append(rt)
+                    mzs.append(spec["m/z array"])
+                    ints.append(spec["intensity array"])
+                elif msLevel == 2 and self.readMs2:
+                    self.addMs2(spec, "mzml", num, rt)
+        return scans, rts, mzs, ints
+
+    def addMs2(self, spec, fmt, num, rt):
+        precursorMz = getPrecursorMz(spec, fmt)
+        if precursorMz is not None:
+            self.ms2.append({"num": num, "retentionTime": rt, "precursorMz": precursorMz,
+                             "mz": spec["m/z array"], "intensity": spec["intensity array"]})
+
+    def readParallel(self, index, nWorkers):
+        # 1. Attributes of scans are read using the scan offset index (without reading peaks)
+        # Peaks of MS1 scans are placed first in the shared arrays, followed by those of MS2 scans (when "readMs2")
+        scans, rts, tasks = [], [], []
+        ms2Scans, ms2Tasks = [], []
+        nTotal, nMs2Total = 0, 0
+        isDouble = False
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            for i, (num, start) in enumerate(index):
+                if i + 1 < len(index):
+                    end = index[i + 1][1]
+                else:
+                    end = size
+                scan, peaks, dataStart = readMzxmlHeader(f, start, end)
+                isMs2 = self.readMs2 and scan.get(b"msLevel") == b"2" and b"precursorMz" in scan
+                if scan.get(b"msLevel") != b"1" and not isMs2:
+                    continue
+                n = int(scan.get(b"peaksCount", b"0"))
+                if dataStart < 0:
+                    n = 0
+                precision = peaks.get(b"precision", b"32").decode()
+                if precision == "64":
+                    isDouble = True
+                rt = float(XMLValueConverter.duration_str_to_float(scan[b"retentionTime"].decode()))
+                task = [dataStart, n, 0, precision, peaks.get(b"byteOrder", b"network").decode(),
+                        peaks.get(b"compressionType", b"none").decode()]
+                if isMs2:
+                    ms2Scans.append((scan[b"num"].decode(), rt, float(scan[b"precursorMz"])))
+                    task[2] = nMs2Total
+                    ms2Tasks.append(task)
+                    nMs2Total += n
+                else:
+                    scans.append(scan[b"num"].decode())
+                    rts.append(rt)
+                    task[2] = nTotal
+                    tasks.append(task)
+                    nTotal += n
+        self.scans = scans
+        self.rts = np.array(rts, dtype=np.float64)
+        self.offsets = np.zeros(len(scans) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([task[1] for task in tasks])
+        self.scanIndex = {num: i for i, num in enumerate(self.scans)}
+        ms2Offsets = np.zeros(len(ms2Scans) + 1, dtype=np.int64)
+        ms2Offsets[1:] = np.cumsum([task[1] for task in ms2Tasks])
+        for task in ms2Tasks:
+            task[2] += nTotal
+        if isDouble:
+            dtype = np.float64
+        else:
+            dtype = np.float32
+
+        # 2. Peaks are decoded by workers (chunks of scans, split by byte ranges) into shared arrays
+        tasks = sorted([tuple(task) for task in tasks + ms2Tasks if task[1] > 0], key=lambda x: x[0])
+        nAll = nTotal + nMs2Total
+        progress.start("decode", self.name, len(tasks), "scans")
+        if len(tasks) == 0:
+            mzArray, intensityArray = np.array([], dtype=dtype), np.array([], dtype=dtype)
+        else:
+            shmMz = shared_memory.SharedMemory(create=True, size=nAll * np.dtype(dtype).itemsize)
+            shmIntensity = shared_memory.SharedMemory(create=True, size=nAll * np.dtype(dtype).itemsize)
+            try:
+                nChunks = min(len(tasks), nWorkers * 4)
+                bounds = np.linspace(tasks[0][0], tasks[-1][0] + 1, nChunks + 1)
+                chunks = [[] for _ in range(nChunks)]
+                for task in tasks:
+                    chunks[int(np.searchsorted(bounds, task[0], side="right")) - 1].append(task)
+                chunks = [chunk for chunk in chunks if len(chunk) > 0]
+                with ProcessPoolExecutor(max_workers=nWorkers, initializer=initProgress,
+                                         initargs=progress.workerArgs()) as executor:
+                    futures = [executor.submit(decodeMzxmlPeaks, self.path, chunk, (shmMz.name, shmIntensity.name),
+                                               dtype, nAll) for chunk in chunks]
+                    for future in futures:
+                        future.result()
+                mzArray = np.ndarray((nAll,), dtype=dtype, buffer=shmMz.buf).copy()
+                intensityArray = np.ndarray((nAll,), dtype=dtype, buffer=shmIntensity.buf).copy()
+            finally:
+                shmMz.close()
+                shmMz.unlink()
+                shmIntensity.close()
+                shmIntensity.unlink()
+        self.mz, self.intensity = mzArray[:nTotal], intensityArray[:nTotal]
+        for i, (num, rt, precursorMz) in enumerate(ms2Scans):
+            start, end = nTotal + ms2Offsets[i], nTotal + ms2Offsets[i + 1]
+            self.ms2.append({"num": num, "retentionTime": rt, "precursorMz": precursorMz,
+                             "mz": mzArray[start:end], "intensity": intensityArray[start:end]})
+
+    def setArrays(self, scans, rts, mzs, ints):
+        self.scans = list(scans)
+        self.rts = np.array(rts, dtype=np.float64)
+        self.offsets = np.zeros(len(scans) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(mz) for mz in mzs])
+        if len(mzs) > 0:
+            self.mz = np.concatenate(mzs)
+            self.intensity = np.concatenate(ints)
+        else:
+            self.mz, self.intensity = np.array([]), np.array([])
+        self.scanIndex = {num: i for i, num in enumerate(self.scans)}
+
+    def spectrum(self, i):
+        # i-th MS1 spectrum (the arrays are views of the concatenated arrays, i.e., no copy)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {"num": self.scans[i], "msLevel": 1, "retentionTime": self.rts[i],
+                "m/z array": self.mz[start:end], "intensity array": self.intensity[start:end]}
+
+    def __getitem__(self, scanNum):
+        return self.spectrum(self.scanIndex[str(scanNum)])
+
+    def __iter__(self):
+        for i in range(len(self.scans)):
+            yield self.spectrum(i)
+
+    def __len__(self):
+        return len(self.scans)
+
+
+def readMs2Spectra(path):
+    # MS2 spectra of a run with their precursor m/z (used for the MS2 confirmation of target metabolites)
+    # Returns a list of dictionaries, {"num", "retentionTime", "precursorMz", "mz", "intensity"}
+    fmt, isCompressed = getFormat(path)
+    if isCompressed:
+        with gzip.open(path, "rb") as f:
+            source = io.BytesIO(f.read())
+    else:
+        source = path
+    if fmt == "mzxml":
+        reader = mzxml.MzXML(source, use_index=False)
+    else:
+        reader = mzml.MzML(source, use_index=False)
+    res = []
+    with reader:
+        for spec in reader:
+            _, num, msLevel, rt = getScanInfo(spec, fmt)
+            if msLevel != 2:
+                continue
+            precursorMz = getPrecursorMz(spec, fmt)
+            if precursorMz is None:     # No precursor information
+                continue
+            res.append({"num": num, "retentionTime": rt, "precursorMz": precursorMz,
+                        "mz": spec["m/z array"], "intensity": spec["intensity array"]})
+    return res
+
+
+def prefetchSpectra(paths, nInFlight=1, nWorkers=1, readMs2=False):
+    # Generator of (path, ms1Spectra) in the order of "paths"
+    # While the spectra of a file are being processed by the caller, those of the next file(s) are read and decoded
+    # in a background process, i.e., file reading and decoding are overlapped with the matching of isotopologues
+    # At most "nInFlight" files are read (or waiting to be consumed) ahead of the caller, which limits the memory usage
+    # When "nInFlight = 0", files are read one by one in the current process
+    # When "readMs2 = True", MS2 spectra are collected in the same pass (see "ms1Spectra")
+    if nInFlight <= 0:
+        for path in paths:
+            yield path, ms1Spectra(path, nWorkers, readMs2)
+        return
+
+    with ProcessPoolExecutor(max_workers=1, initializer=initProgress, initargs=progress.workerArgs()) as executor:
+        queue = deque()
+        paths = iter(paths)
+        try:
+            for path in paths:
+                queue.append((path, executor.submit(ms1Spectra, path, nWorkers, readMs2)))
+                if len(queue) >= nInFlight:
+                    break
+            while len(queue) > 0:
+                path, future = queue.popleft()
+                spectra = future.result()
+                # Submit the next file before handing over the current one, so that it is decoded in the meantime
+                for nextPath in paths:
+                    queue.append((nextPath, executor.submit(ms1Spectra, nextPath, nWorkers, readMs2)))
+                    break
+                yield path, spectra
+                del spectra
+        finally:
+            for _, future in queue:
+                future.cancel()
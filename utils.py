@@ -1,5 +1,7 @@
-import re, sys, os, pickle, numpy as np, pandas as pd
-from pyteomics import mass
+import re, sys, os, json, time, shutil, pickle, threading, multiprocessing, numpy as np, pandas as pd
+from datetime import timedelta
+from pyteomics import mass, mgf
+from scipy import sparse
 
 
 def getParams(paramFile):
@@ -144,6 +146,132 @@ def calcMS2Similarity(featSpec, libSpec):
     return normDotProduct
 
 
+class ms2Library:
+    # MS2 spectra of library compounds prepared once for the batch calculation of MS2 similarity
+    # - The strongest peaks (up to 30) of each spectrum are kept (sorted by intensity, the same as calcMS2Similarity)
+    # - The peaks are binarized into 1-Da bins, i.e., a sparse matrix (spectra x bins)
+    def __init__(self, libSpecs, nPeaks=30):
+        self.nPeaks = nPeaks
+        self.mz, self.sqrtIntensity, self.nPeaksArray = topPeaks(libSpecs, nPeaks)
+        self.n = len(libSpecs)
+        self.matrix = binarizePeaks(self.mz, self.nPeaksArray, 0)
+
+    def __len__(self):
+        return self.n
+
+
+def readMS2Library(libFile):
+    # MS2 spectra of library compounds from a MGF file
+    # Each spectrum is linked to a target metabolite by "ID" (e.g., HMDB0000122), or "TITLE" when "ID" is not given
+    libSpecs, libIds = [], []
+    with mgf.read(libFile) as reader:
+        for spec in reader:
+            libSpecs.append({"mz": spec["m/z array"], "intensity": spec["intensity array"]})
+            libIds.append(spec["params"].get("id", spec["params"].get("title")))
+    return ms2Library(libSpecs), np.array(libIds, dtype=object)
+
+
+def topPeaks(specs, nPeaks):
+    # Strongest peaks of spectra, arranged to (number of spectra) x nPeaks arrays (padded with inf and 0)
+    mzArray = np.full((len(specs), nPeaks), np.inf)
+    intensityArray = np.zeros((len(specs), nPeaks))
+    nPeaksArray = np.zeros(len(specs), dtype=int)
+    for i, spec in enumerate(specs):
+        ind = np.argsort([-i for i in spec["intensity"]])[0:nPeaks]
+        nPeaksArray[i] = len(ind)
+        mzArray[i, :len(ind)] = np.array(spec["mz"], dtype=float)[ind]
+        intensityArray[i, :len(ind)] = np.sqrt(np.array(spec["intensity"], dtype=float)[ind])
+    return mzArray, intensityArray, nPeaksArray
+
+
+def binarizePeaks(mzArray, nPeaksArray, spread):
+    # Sparse (binary) matrix of spectra x 1-Da bins
+    # When "spread = 1", each peak marks the bins of m/z - 0.5 and m/z + 0.5, so that a query peak shares a bin
+    # with every library peak within 0.5 Da (i.e., all pairs of spectra possibly having a non-zero similarity are found)
+    rows, cols = [], []
+    for i in range(mzArray.shape[0]):
+        mzs = mzArray[i, :nPeaksArray[i]]
+        if spread == 1:
+            bins = np.unique(np.concatenate([np.floor(mzs - 0.5), np.floor(mzs + 0.5)]))
+        else:
+            bins = np.unique(np.floor(mzs))
+        bins = np.maximum(bins, 0)    # A peak below 0.5 m/z would mark the bin of -1
+        rows.extend([i] * len(bins))
+        cols.extend(bins.astype(int))
+    nBins = int(max(cols, default=0)) + 2
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(mzArray.shape[0], nBins))
+
+
+def calcMS2SimilarityPairs(featMz, featIntensity, nFeat, libMz, libIntensity, nLib, nPeaks=30):
+    # Vectorized version of calcMS2Similarity for many pairs of spectra (one pair per row of input arrays)
+    # The same procedure (k strongest peaks, merging m/z values within 0.5 Da and normalized dot-product) is applied
+    nPairs = featMz.shape[0]
+    k = np.minimum(nPeaks, np.minimum(nFeat, nLib))
+    cols = np.arange(nPeaks)
+    featMask = cols[None, :] < k[:, None]
+    libMask = cols[None, :] < k[:, None]
+    mzArray = np.concatenate([np.where(featMask, featMz, np.inf), np.where(libMask, libMz, np.inf)], axis=1)
+    featArray = np.concatenate([np.where(featMask, featIntensity, 0), np.zeros((nPairs, nPeaks))], axis=1)
+    libArray = np.concatenate([np.zeros((nPairs, nPeaks)), np.where(libMask, libIntensity, 0)], axis=1)
+    ind = np.argsort(mzArray, axis=1, kind="stable")
+    mzArray = np.take_along_axis(mzArray, ind, axis=1)
+    featArray = np.take_along_axis(featArray, ind, axis=1)
+    libArray = np.take_along_axis(libArray, ind, axis=1)
+
+    # Peaks within 0.5 Da from the lowest m/z of a group are merged into the group (the same as calcMS2Similarity)
+    n = mzArray.shape[1]
+    groups = np.zeros(mzArray.shape, dtype=int)
+    val = mzArray[:, 0].copy()
+    with np.errstate(invalid="ignore"):    # inf - inf of padded peaks (which have no intensity)
+        for j in range(1, n):
+            isNew = ~(np.abs(mzArray[:, j] - val) <= 0.5)
+            val = np.where(isNew, mzArray[:, j], val)
+            groups[:, j] = groups[:, j - 1] + isNew
+    groups += (np.arange(nPairs) * n)[:, None]
+    s1 = np.bincount(groups.ravel(), weights=featArray.ravel(), minlength=nPairs * n).reshape(nPairs, n)
+    s2 = np.bincount(groups.ravel(), weights=libArray.ravel(), minlength=nPairs * n).reshape(nPairs, n)
+    num = (s1 * s2).sum(axis=1)
+    den = (s1 ** 2).sum(axis=1) * (s2 ** 2).sum(axis=1)
+    normDotProduct = np.zeros(nPairs)
+    normDotProduct[den > 0] = num[den > 0] / np.sqrt(den[den > 0])
+    return normDotProduct
+
+
+def calcMS2SimilarityBatch(featSpecs, library, blockSize=1000, pairBlockSize=100000):
+    # Calculation of MS2 similarity between many features and library compounds
+    # Input arguments
+    # featSpecs = list of MS2 spectra of features (dictionary with keys "mz" and "intensity", same as calcMS2Similarity)
+    # library = an "ms2Library" object (or a list of MS2 spectra of library compounds)
+    # Output
+    # A sparse matrix (features x library compounds) of similarity scores, equal to calcMS2Similarity of each pair
+    # For each block of features, pairs sharing any peak within 0.5 Da are found by a single sparse matrix
+    # multiplication, and only those pairs are scored (the other pairs have zero similarity)
+    if not isinstance(library, ms2Library):
+        library = ms2Library(library)
+    nPeaks = library.nPeaks
+    scores = []
+    for start in range(0, len(featSpecs), blockSize):
+        featMz, featIntensity, nFeat = topPeaks(featSpecs[start:start + blockSize], nPeaks)
+        featMatrix = binarizePeaks(featMz, nFeat, 1)
+        nBins = max(featMatrix.shape[1], library.matrix.shape[1])
+        featMatrix.resize((featMatrix.shape[0], nBins))
+        libMatrix = library.matrix.copy()
+        libMatrix.resize((libMatrix.shape[0], nBins))
+        candidates = (featMatrix @ libMatrix.T).tocoo()
+        rows, cols = candidates.row, candidates.col
+        values = np.zeros(len(rows))
+        for i in range(0, len(rows), pairBlockSize):
+            r, c = rows[i:i + pairBlockSize], cols[i:i + pairBlockSize]
+            values[i:i + pairBlockSize] = calcMS2SimilarityPairs(featMz[r], featIntensity[r], nFeat[r], library.mz[c],
+                                                                 library.sqrtIntensity[c], library.nPeaksArray[c], nPeaks)
+        scores.append(sparse.csr_matrix((values, (rows, cols)), shape=(featMz.shape[0], len(library))))
+    if len(scores) == 0:
+        return sparse.csr_matrix((0, len(library)))
+    res = sparse.vstack(scores).tocsr()
+    res.eliminate_zeros()
+    return res
+
+
 class progressBar:
     def __init__(self, total):
         self.total = total
@@ -152,20 +280,304 @@ class progressBar:
         self.progress = 0
         self.block = 0
         self.status = ""
+        self.width = 0
 
-    def increment(self, nIncrement=None):
+    def increment(self, nIncrement=None, info=""):
+        # info = optional text shown after the percentage, e.g., throughput and ETA
         if nIncrement == None:
-            self.count += 1
+            self.update(self.count + 1)
         else:
-            self.count = nIncrement
-        self.progress = self.count / self.total
-        self.block = int(round(self.barLength * self.progress))
+            self.update(nIncrement)
         if self.progress == 1:
             self.status = "Done...\r\n"
         else:
             self.status = ""
         #         self.status = str(self.count) + "/" + str(self.total)
-        text = "\r  Progress: [{0}] {1}% {2}".format("#" * self.block + "-" * (self.barLength - self.block),
-                                                     int(self.progress * 100), self.status)
+        text = "\r  Progress: " + self.text(info)
+        # Pad with spaces to erase the remainder of a longer previous line
+        width = len(text)
+        text = text.ljust(self.width) + self.status
+        self.width = width
         sys.stdout.write(text)
         sys.stdout.flush()
+
+    def update(self, count):
+        self.count = count
+        self.progress = self.count / self.total
+        self.block = int(round(self.barLength * self.progress))
+
+    def text(self, info=""):
+        return "[{0}] {1}% {2} ".format("#" * self.block + "-" * (self.barLength - self.block),
+                                         int(self.progress * 100), info)
+
+
+def initProgress(queue, interval):
+    # Initializer of worker processes; progress events of a worker are forwarded to the main process via "queue"
+    progress.forward(queue, interval)
+
+
+class progressReporter:
+    # Live progress of the stages of the pipeline, i.e., throughput (e.g., scans/sec, targets/sec) and ETA of each file
+    # Stages report their progress by
+    #   progress.start(stage, name, total, unit) (optional, when the total amount of work is known)
+    #   progress.update(stage, name, n) (n units of work are done)
+    #   progress.finish(stage, name)
+    # and the progress is rendered by "progressBar" on a terminal, or written to a JSON-lines log otherwise
+    # (one line per event, {"time", "stage", "file", "done", "total", "unit", "rate", "eta", "elapsed"})
+    # Events are throttled, i.e., the progress is rendered at most once per "interval" seconds
+    # Worker processes (initialized by "initProgress") forward the accumulated counts to the main process, where the
+    # counts of the same stage and file are summed, so that files (or chunks of a file) processed in parallel are
+    # aggregated correctly
+    # The time spent by the reporter itself is measured and written to the JSON-lines log by "close"
+    def __init__(self):
+        self.mode = None    # None (disabled), "render" (main process) or "forward" (worker process)
+        self.interval = 0.5
+        self.overhead, self.workerOverhead = 0.0, 0.0
+        self.lock = threading.Lock()
+
+    def configure(self, params):
+        # Enable the reporter in the main process, using the parameters
+        # "progress" = 0 (disabled) or 1 (enabled, default)
+        # "progress_interval" = minimum interval (sec) between progress updates (default = 0.5)
+        # "progress_log" = JSON-lines log file used when the standard output is not a terminal
+        #                  (default = tracer_progress.jsonl)
+        # "progress_overhead" = 1 (print the overhead of the reporter) or 0 (default, only in the JSON-lines log)
+        if "progress" in params and params["progress"] == "0":
+            return
+        try:
+            self.interval = float(params["progress_interval"])
+        except KeyError:
+            self.interval = 0.5
+        self.stream = None
+        if not sys.stdout.isatty():
+            try:
+                logFile = params["progress_log"]
+            except KeyError:
+                logFile = "tracer_progress.jsonl"
+            self.stream = open(logFile, "w")
+        self.states, self.bars, self.texts = {}, {}, {}
+        self.lineWidth = 0
+        self.printOverhead = 0
+        if "progress_overhead" in params and params["progress_overhead"] == "1":
+            self.printOverhead = 1
+        self.queue, self.drainThread = None, None
+        self.startTime = time.perf_counter()
+        self.lastEmit = 0.0
+        self.mode = "render"
+
+    def forward(self, queue, interval):
+        # A forked worker may inherit the lock in the acquired state, so a new one is made
+        self.lock = threading.Lock()
+        self.mode, self.queue, self.interval = None, queue, interval
+        if queue is not None:
+            self.mode = "forward"
+            self.deltas = {}
+            self.overhead, self.lastEmit = 0.0, 0.0
+
+    def workerArgs(self):
+        # Initializer arguments of worker processes (the queue is created when the first worker pool is made)
+        if self.mode == "render" and self.queue is None:
+            self.queue = multiprocessing.Queue()
+            self.drainThread = threading.Thread(target=self.drain, daemon=True)
+            self.drainThread.start()
+        if self.mode is None:
+            return None, self.interval
+        return self.queue, self.interval
+
+    def start(self, stage, name, total=None, unit="items"):
+        if self.mode is None:
+            return
+        t = time.perf_counter()
+        with self.lock:
+            if self.mode == "forward":
+                self.deltas.setdefault((stage, name), [0, total, unit, time.time(), False])[1:3] = [total, unit]
+                self.flush()    # So that the total is known to the main process before the updates of other workers
+            else:
+                self.apply(stage, name, 0, total, unit, time.time(), False)
+            self.overhead += time.perf_counter() - t
+
+    def update(self, stage, name, n=1):
+        if self.mode is None:
+            return
+        t = time.perf_counter()
+        with self.lock:
+            key = (stage, name)
+            if self.mode == "forward":
+                if key not in self.deltas:
+                    self.deltas[key] = [0, None, "items", time.time(), False]
+                self.deltas[key][0] += n
+                if t - self.lastEmit >= self.interval:
+                    self.flush()
+            else:
+                if key not in self.states:
+                    self.apply(stage, name, 0, None, "items", time.time(), False)
+                self.states[key]["done"] += n
+                if t - self.lastEmit >= self.interval:
+                    self.emit()
+            self.overhead += time.perf_counter() - t
+
+    def finish(self, stage, name):
+        if self.mode is None:
+            return
+        t = time.perf_counter()
+        with self.lock:
+            if self.mode == "forward":
+                self.deltas.setdefault((stage, name), [0, None, "items", time.time(), False])[4] = True
+                self.flush()
+            else:
+                self.apply(stage, name, 0, None, None, time.time(), True)
+                self.emit()
+            self.overhead += time.perf_counter() - t
+
+    def flush(self):
+        # Worker process; send the accumulated counts (and the overhead) to the main process
+        if self.mode != "forward":
+            return
+        now = time.time()
+        events = [(stage, name, delta[0], delta[1], delta[2], now, delta[4])
+                  for (stage, name), delta in self.deltas.items()]
+        if len(events) > 0 or self.overhead > 0:
+            self.queue.put((events, self.overhead))
+        self.deltas, self.overhead = {}, 0.0
+        self.lastEmit = time.perf_counter()
+
+    def drain(self):
+        # Main process; receive the events of worker processes (in a background thread)
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            t = time.perf_counter()
+            events, overhead = message
+            with self.lock:
+                isFinished = False
+                for stage, name, n, total, unit, eventTime, finished in events:
+                    self.apply(stage, name, n, total, unit, eventTime, finished)
+                    isFinished = isFinished or finished
+                self.workerOverhead += overhead
+                if isFinished or t - self.lastEmit >= self.interval:
+                    self.emit()
+                self.overhead += time.perf_counter() - t
+
+    def apply(self, stage, name, n, total, unit, eventTime, finished):
+        key = (stage, name)
+        if key not in self.states:
+            self.states[key] = {"done": 0, "total": None, "unit": "items", "start": eventTime, "last": eventTime,
+                                "finished": False, "changed": True}
+        state = self.states[key]
+        state["done"] += n
+        if total is not None:
+            state["total"] = total
+        if unit is not None and unit != "items":
+            state["unit"] = unit
+        state["start"] = min(state["start"], eventTime)
+        state["last"] = max(state["last"], eventTime)
+        state["finished"] = state["finished"] or finished
+        state["changed"] = True
+
+    def drawLine(self):
+        if len(self.texts) == 0:
+            return
+        line = "\r  Progress: " + "| ".join(self.texts.values())
+        # A line longer than the terminal would wrap, and "\r" would not return to its beginning
+        line = line[:shutil.get_terminal_size().columns]
+        sys.stdout.write(line.ljust(self.lineWidth))
+        sys.stdout.flush()
+        self.lineWidth = len(line)
+
+    def log(self, text):
+        # Print a message without breaking the progress line on a terminal
+        with self.lock:
+            if self.mode == "render" and self.stream is None and self.lineWidth > 0:
+                sys.stdout.write("\r" + " " * self.lineWidth + "\r" + text + "\n")
+                self.lineWidth = 0
+                self.drawLine()
+            else:
+                print(text)
+
+    def emit(self):
+        now = time.time()
+        finished = []
+        for (stage, name), state in list(self.states.items()):
+            if not state["changed"]:
+                continue
+            state["changed"] = False
+            if state["finished"]:
+                elapsed = state["last"] - state["start"]
+                if state["total"] is None:
+                    state["total"] = state["done"]
+            else:
+                elapsed = now - state["start"]
+            if elapsed > 0:
+                rate = state["done"] / elapsed
+            else:
+                rate = 0.0
+            eta = None
+            if state["total"] is not None and rate > 0:
+                eta = max(state["total"] - state["done"], 0) / rate
+            if self.stream is not None:
+                self.stream.write(json.dumps({"time": round(now, 3), "stage": stage, "file": name,
+                                              "done": state["done"], "total": state["total"], "unit": state["unit"],
+                                              "rate": round(rate, 3), "eta": None if eta is None else round(eta, 3),
+                                              "elapsed": round(elapsed, 3)}) + "\n")
+            else:
+                info = "{} {}, {:.1f} {}/sec".format(stage, name, rate, state["unit"])
+                if eta is not None and not state["finished"]:
+                    info += ", ETA {}".format(timedelta(seconds=int(eta)))
+                if state["total"]:
+                    if (stage, name) not in self.bars:
+                        self.bars[(stage, name)] = progressBar(state["total"])
+                    bar = self.bars[(stage, name)]
+                    bar.total = state["total"]
+                    if state["finished"]:
+                        bar.update(state["total"])
+                    else:
+                        bar.update(min(state["done"], state["total"]))
+                    self.texts[(stage, name)] = bar.text(info)
+                else:
+                    self.texts[(stage, name)] = "{} {} ".format(state["done"], info)
+            if state["finished"]:
+                del self.states[(stage, name)]
+                self.bars.pop((stage, name), None)
+                if self.stream is None:
+                    finished.append(self.texts.pop((stage, name)))
+        if self.stream is None:
+            # All files and stages in progress (e.g., decoding the next file while matching the current one) share
+            # one line, so that they do not overwrite each other; finished ones are left above the line
+            for text in finished:
+                line = ("\r  Progress: " + text)[:shutil.get_terminal_size().columns - len("Done...")] + "Done..."
+                sys.stdout.write(line.ljust(self.lineWidth) + "\r\n")
+                self.lineWidth = 0
+            self.drawLine()
+        if self.stream is not None:
+            self.stream.flush()
+        self.lastEmit = time.perf_counter()
+
+    def close(self):
+        # Stop receiving the events of worker processes and report the overhead of the reporter itself
+        if self.mode != "render":
+            return
+        if self.drainThread is not None:
+            self.queue.put(None)
+            self.drainThread.join()
+        with self.lock:
+            self.emit()
+            if self.stream is None and self.lineWidth > 0:
+                sys.stdout.write("\r\n")
+        elapsed = time.perf_counter() - self.startTime
+        pct = self.overhead / elapsed * 100 if elapsed > 0 else 0.0
+        if self.stream is not None:
+            self.stream.write(json.dumps({"time": round(time.time(), 3), "stage": "summary",
+                                          "overhead": round(self.overhead, 6), "overheadPct": round(pct, 4),
+                                          "workerOverhead": round(self.workerOverhead, 6),
+                                          "elapsed": round(elapsed, 3)}) + "\n")
+            self.stream.flush()
+            self.stream.close()
+        if self.printOverhead == 1:
+            print("  Progress reporting overhead: {:.3f} sec in the main process ({:.2f}% of {:.1f} sec), "
+                  "{:.3f} sec in worker processes".format(self.overhead, pct, elapsed, self.workerOverhead))
+        self.mode = None
+
+
+# Progress reporter of the current process (disabled until "progress.configure" or "initProgress" is called)
+progress = progressReporter()